@@ -142,6 +142,7 @@ type LocalModelConfig struct {
 	LogRequests   bool
 	LogResponses  bool
 	EnabledModels []string // List of enabled local models
+	APIKey        string   // Bearer key sent to the Python model server; one of its MODEL_API_KEYS
 
 	// Third-party model support (阿里百炼/Alibaba DashScope)
 	ThirdParty ThirdPartyModelConfig
@@ -261,6 +262,7 @@ func New() *Config {
 			LogRequests:   getEnvBool("LOCAL_MODEL_LOG_REQUESTS", true),
 			LogResponses:  getEnvBool("LOCAL_MODEL_LOG_RESPONSES", true),
 			EnabledModels: getEnvStringSlice("ENABLED_LOCAL_MODELS", []string{"tiny-llama", "phi-2", "miniLM"}),
+			APIKey:        getEnv("LOCAL_MODEL_API_KEY", ""),
 			// Third-party model configuration
 			ThirdParty: ThirdPartyModelConfig{
 				Enabled:      getEnvBool("THIRD_PARTY_MODEL_ENABLED", false),
@@ -335,6 +335,10 @@ func (pms *PythonModelServer) retryRequest(ctx context.Context, url string, requ
 		}
 
 		req.Header.Set("Content-Type", "application/json")
+		// The model server enforces its keys on every endpoint once MODEL_API_KEYS is set
+		if pms.config.APIKey != "" {
+			req.Header.Set("Authorization", "Bearer "+pms.config.APIKey)
+		}
 
 		// Send request
 		resp, err = pms.httpClient.Do(req)
@@ -0,0 +1,531 @@
+import asyncio
+import copy
+import functools
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import torch
+from starlette.concurrency import iterate_in_threadpool
+from transformers import DynamicCache, StaticCache, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+logger = logging.getLogger(__name__)
+
+def _sampling_kwargs(temperature: float) -> Dict[str, Any]:
+    """generate() arguments for a temperature; zero selects plain greedy decoding"""
+    if temperature > 0:
+        return {"do_sample": True, "temperature": temperature}
+    # Clear any sampling defaults from the checkpoint's generation config so no
+    # logits warpers are built for the greedy path
+    return {"do_sample": False, "num_beams": 1, "temperature": None, "top_p": None, "top_k": None}
+
+def _crop_cache(cache: DynamicCache, length: int):
+    """Cut a DynamicCache back to its first length tokens"""
+    excess = cache.get_seq_length() - length
+    if excess <= 0:
+        return
+    if hasattr(cache, "crop"):
+        # A negative argument removes tokens from the end wherever crop exists
+        cache.crop(-excess)
+        return
+    # transformers 4.41 has no crop; slice each layer's (batch, heads, seq, dim) tensors
+    for layer in range(len(cache.key_cache)):
+        cache.key_cache[layer] = cache.key_cache[layer][..., :length, :]
+        cache.value_cache[layer] = cache.value_cache[layer][..., :length, :]
+    cache._seen_tokens = length
+
+class _StopOnEvent(StoppingCriteria):
+    """Stops generation once the consumer of a stream has gone away"""
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+class _TrackingStreamer(TextIteratorStreamer):
+    """TextIteratorStreamer that also remembers the last token generated and any generation failure"""
+    last_token_id: Optional[int] = None
+    error: Optional[BaseException] = None
+
+    def put(self, value):
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            self.last_token_id = int(value.reshape(-1)[-1])
+        super().put(value)
+
+class GenerationBatcher:
+    """Coalesces concurrent generation requests into padded model.generate batches"""
+    # Capacity of the reusable single-sequence static cache: longest prompt plus completion
+    static_cache_len = 2048 + 1024
+    # Prompt widths a compiled model pads up to, so prefill compiles once per bucket
+    # rather than once per prompt length
+    prefill_buckets = (64, 128, 256, 512, 1024, 2048)
+    # Granularity at which prompt prefixes are matched against cached KV
+    prefix_block_size = 16
+    # Cached prefixes are evicted once allocated GPU memory passes this share of the device.
+    # Kept well below ResourceManager.gpu_memory_threshold (0.9), whose driver-side reading
+    # also counts the CUDA context: cached prefixes alone must never hold the device past
+    # admission, since eviction only runs after a generation that would then never be admitted
+    prefix_cache_memory_fraction = 0.75
+
+    def __init__(self, model, tokenizer, max_batch: int = 8, max_wait: float = 0.005, max_cached_prefixes: int = 32,
+                 max_generation_time: float = 25.0):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_cached_prefixes = max_cached_prefixes
+        # Wall-clock budget per generate call; generate stops (MaxTimeCriteria) and
+        # returns what it has so an overlong request cannot hold the model thread
+        self.max_generation_time = max_generation_time
+        # Tokens with which the model ends a completion itself; any other last token means
+        # the completion was cut off by its token or time budget
+        generation_eos = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+        if not isinstance(generation_eos, list):
+            generation_eos = [generation_eos]
+        self._eos_token_ids = {tokenizer.eos_token_id, *generation_eos} - {None}
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # LRU of prompt KV caches with the prefix keys and prefix tokens each one covers, keyed by
+        # its longest prefix; the index maps every cached prefix key to the entry that holds it
+        self._prefix_cache: "OrderedDict[Tuple[int, int], Tuple[DynamicCache, List[Tuple[int, int]], Tuple[int, ...]]]" = OrderedDict()
+        self._prefix_index: Dict[Tuple[int, int], Tuple[int, int]] = {}
+        # Every model call runs on this one thread: the GPU executes one generate at a
+        # time anyway, and the compiled graphs and static cache must not be shared
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Batch sizes a compiled model pads a batch up to: powers of two, capped at max_batch.
+        # Prefill is compute-bound, so padding a pair of requests to a full batch would multiply
+        # its work; rounding up at most doubles it while keeping few graphs and caches
+        self._static_batch_sizes = tuple(sorted({min(2 ** i, max_batch) for i in range(max_batch.bit_length() + 1)}))
+        # Preallocated static caches for a compiled model, one per batch size used so far
+        self._static_caches: Dict[int, StaticCache] = {}
+
+    def start(self):
+        """Start the batch worker on the running event loop"""
+        # Grad mode is per thread; switch it off for good on the model thread so the cache
+        # copies and crops between generate calls never record autograd either
+        self._executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="generate",
+            initializer=torch.set_grad_enabled,
+            initargs=(False,)
+        )
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._batch_worker())
+
+    async def stop(self):
+        """Cancel the batch worker and fail any requests still queued"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        while self._queue is not None and not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Generation batcher stopped"))
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def warm_up(self):
+        """Run throwaway generations through the same paths real requests take.
+
+        A compiled model gets a prefill graph per prompt bucket and batch size and a
+        decode graph per batch size; building all of them here keeps compilation out
+        of the requests' max_generation_time budget.
+        """
+        pad_token_id = self.tokenizer.pad_token_id
+        if self.model.generation_config.cache_implementation != "static":
+            await self._run_on_model_thread(self._generate_batch, [[pad_token_id] * 4], [1], 0.0)
+            return
+
+        await self._run_on_model_thread(self._raise_graph_limit)
+        for batch_size in self._static_batch_sizes:
+            for bucket in self.prefill_buckets:
+                await self._run_on_model_thread(
+                    self._generate_batch,
+                    [[pad_token_id] * bucket] * batch_size,
+                    [2] * batch_size,
+                    0.0
+                )
+
+    def _raise_graph_limit(self):
+        """Let dynamo keep one prefill graph per bucket and a decode graph at every batch size.
+
+        Past its default limit of 8 graphs the rest would quietly run eagerly. Set on the
+        model thread, where compilation happens, since newer torch keeps the setting per thread.
+        """
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, len(self._static_batch_sizes) * (len(self.prefill_buckets) + 1)
+        )
+
+    def finish_reason(self, completion_ids: List[int]) -> str:
+        """OpenAI finish_reason for a completion: stop if the model ended it, length if a budget cut it off"""
+        return "stop" if completion_ids and completion_ids[-1] in self._eos_token_ids else "length"
+
+    async def _run_on_model_thread(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+
+    async def generate(self, input_ids: List[int], max_new_tokens: int, temperature: float, prefix_length: int = 0) -> List[int]:
+        """Queue a tokenized prompt and wait for its completion token ids.
+
+        Prompts that run alone reuse the KV cache of the longest earlier prompt prefix
+        they share, at block granularity. prefix_length additionally marks an exact
+        reusable boundary such as the end of a system prompt.
+        """
+        if self._queue is None:
+            raise RuntimeError("Generation batcher not started")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((input_ids, future, {
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "prefix_length": prefix_length
+        }))
+        return await future
+
+    async def stream(self, input_ids: List[int], max_new_tokens: int, temperature: float,
+                     prefix_length: int = 0) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        """Generate a single prompt outside the batch.
+
+        Yields (text, None) for decoded text as it is produced, then ("", finish_reason).
+        """
+        if self._executor is None:
+            raise RuntimeError("Generation batcher not started")
+
+        streamer = _TrackingStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop_event = threading.Event()
+        self._executor.submit(self._generate_streaming, input_ids, prefix_length, max_new_tokens, temperature, streamer, stop_event)
+        try:
+            async for text in iterate_in_threadpool(streamer):
+                if text:
+                    yield text, None
+            if streamer.error is not None:
+                raise RuntimeError("Streaming generation failed") from streamer.error
+            last_token_id = streamer.last_token_id
+            yield "", self.finish_reason([] if last_token_id is None else [last_token_id])
+        finally:
+            # Client disconnected or the stream finished; either way stop generating
+            stop_event.set()
+
+    def _generate_streaming(self, input_ids: List[int], prefix_length: int, max_new_tokens: int, temperature: float,
+                            streamer: TextIteratorStreamer, stop_event: threading.Event):
+        prefix_keys, cache, cached_length = [], None, 0
+        try:
+            padded = self._pad_prompts([input_ids])
+            if self.model.generation_config.cache_implementation is None:
+                # Prefill only what the prefix cache does not already hold
+                prefix_keys, cache, cached_length = self._cached_prefix(input_ids, prefix_length)
+            with torch.inference_mode():
+                if cache is None:
+                    cache_kwargs = self._cache_kwargs(1, padded["input_ids"].shape[1] + max_new_tokens)
+                else:
+                    cache_kwargs = {"past_key_values": cache}
+                self.model.generate(
+                    input_ids=padded["input_ids"],
+                    attention_mask=padded["attention_mask"],
+                    max_new_tokens=max_new_tokens,
+                    **_sampling_kwargs(temperature),
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    use_cache=True,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([_StopOnEvent(stop_event)]),
+                    max_time=self.max_generation_time,
+                    **cache_kwargs
+                )
+        except Exception as e:
+            logger.error(f"Streaming generation failed: {str(e)}")
+            # Unblock the consumer, which would otherwise wait on the streamer forever
+            streamer.error = e
+            streamer.end()
+            return
+
+        if prefix_keys and prefix_keys[-1][0] > cached_length:
+            self._store_prefix(cache, prefix_keys, input_ids)
+
+    async def _batch_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+
+            # Give concurrent requests a few milliseconds to join the batch
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Sampling settings apply to a whole generate call, so group on them
+            groups: Dict[float, List[Tuple[List[int], asyncio.Future, Dict[str, Any]]]] = {}
+            for item in batch:
+                if not item[1].done():
+                    groups.setdefault(item[2]["temperature"], []).append(item)
+
+            for temperature, items in groups.items():
+                try:
+                    if len(items) == 1:
+                        input_ids, _, params = items[0]
+                        results = await self._run_on_model_thread(
+                            self._generate_with_prefix,
+                            input_ids,
+                            params["prefix_length"],
+                            params["max_new_tokens"],
+                            temperature
+                        )
+                    else:
+                        results = await self._run_on_model_thread(
+                            self._generate_batch,
+                            [input_ids for input_ids, _, _ in items],
+                            [params["max_new_tokens"] for _, _, params in items],
+                            temperature
+                        )
+                except Exception as e:
+                    logger.error(f"Batched generation failed for {len(items)} requests: {str(e)}")
+                    for _, future, _ in items:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+
+                for (_, future, _), completion_ids in zip(items, results):
+                    if not future.done():
+                        future.set_result(completion_ids)
+
+    def _generate_batch(self, prompts: List[List[int]], max_new_tokens: List[int], temperature: float) -> List[List[int]]:
+        """Pad the prompts into one tensor, generate once and split the rows back out"""
+        request_count = len(prompts)
+        if self.model.generation_config.cache_implementation == "static" and request_count > 1:
+            # Fill the batch with copies of the last prompt up to the next compiled batch size,
+            # so it reuses that size's static cache and graphs
+            padding = next(size for size in self._static_batch_sizes if size >= request_count) - request_count
+            prompts = prompts + [prompts[-1]] * padding
+            max_new_tokens = max_new_tokens + [max_new_tokens[-1]] * padding
+        padded = self._pad_prompts(prompts)
+
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                input_ids=padded["input_ids"],
+                attention_mask=padded["attention_mask"],
+                max_new_tokens=max(max_new_tokens),
+                **_sampling_kwargs(temperature),
+                pad_token_id=self.tokenizer.pad_token_id,
+                use_cache=True,
+                max_time=self.max_generation_time,
+                **self._cache_kwargs(len(prompts), padded["input_ids"].shape[1] + max(max_new_tokens))
+            )
+
+        if request_count > 1:
+            logger.info(f"Generated batch of {request_count} requests")
+        # Prompts are left-padded, so every completion starts at the same column
+        return self._split_completions(outputs, padded["input_ids"].shape[1], max_new_tokens)[:request_count]
+
+    def _generate_with_prefix(self, input_ids: List[int], prefix_length: int, max_new_tokens: int, temperature: float) -> List[List[int]]:
+        """Generate a single prompt, seeding the KV cache with the longest cached prefix of it.
+
+        The prompt's own KV cache is kept afterwards, so the next turn of a conversation,
+        which repeats this prompt, only prefills its new tokens.
+        """
+        # A static cache (compiled model) is allocated by generate itself
+        if self.model.generation_config.cache_implementation is not None:
+            return self._generate_batch([input_ids], [max_new_tokens], temperature)
+
+        prefix_keys, cache, cached_length = self._cached_prefix(input_ids, prefix_length)
+        prompt = self._to_device(torch.tensor([input_ids]))
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                input_ids=prompt,
+                attention_mask=torch.ones_like(prompt),
+                past_key_values=cache,
+                max_new_tokens=max_new_tokens,
+                **_sampling_kwargs(temperature),
+                pad_token_id=self.tokenizer.pad_token_id,
+                use_cache=True,
+                max_time=self.max_generation_time
+            )
+
+        if prefix_keys and prefix_keys[-1][0] > cached_length:
+            self._store_prefix(cache, prefix_keys, input_ids)
+        return self._split_completions(outputs, prompt.shape[1], [max_new_tokens])
+
+    def _cached_prefix(self, input_ids: List[int], prefix_length: int) -> Tuple[List[Tuple[int, int]], DynamicCache, int]:
+        """The prompt's prefix keys, a private KV cache seeded with its longest cached prefix, and that prefix's length"""
+        prefix_keys = self._prefix_keys(input_ids, prefix_length)
+        for length, key in reversed(prefix_keys):
+            entry_key = self._prefix_index.get((length, key))
+            if entry_key is None:
+                continue
+            cached, _, tokens = self._prefix_cache[entry_key]
+            # Keys are built-in hashes, which can be made to collide; only the tokens prove a match
+            if tokens[:length] != tuple(input_ids[:length]):
+                continue
+            self._prefix_cache.move_to_end(entry_key)
+            # generate extends the cache in place, so hand it a copy cut to the shared prefix
+            cache = copy.deepcopy(cached)
+            _crop_cache(cache, length)
+            return prefix_keys, cache, length
+        return prefix_keys, DynamicCache(), 0
+
+    def _prefix_keys(self, input_ids: List[int], prefix_length: int) -> List[Tuple[int, int]]:
+        """(length, key) of each reusable prefix of a prompt, shortest first.
+
+        Every whole block of prefix_block_size tokens chains its hash onto the blocks
+        before it, as in a radix tree, so prompts that share leading blocks share keys.
+        A system prompt boundary (prefix_length) gets a key of its own. The last prompt
+        token is never part of a prefix, since generate needs at least one to run.
+        """
+        block_size = self.prefix_block_size
+        keys = []
+        chain = 0
+        for start in range(0, len(input_ids), block_size):
+            end = start + block_size
+            if start < prefix_length < min(end, len(input_ids)):
+                keys.append((prefix_length, hash((chain, tuple(input_ids[start:prefix_length])))))
+            if end >= len(input_ids):
+                break
+            chain = hash((chain, tuple(input_ids[start:end])))
+            keys.append((end, chain))
+        return keys
+
+    def _store_prefix(self, cache: DynamicCache, prefix_keys: List[Tuple[int, int]], input_ids: List[int]):
+        """Keep a prompt's KV cache cut to its longest prefix, indexed under all of its prefixes"""
+        entry_key = prefix_keys[-1]
+        _crop_cache(cache, entry_key[0])
+        self._prefix_cache[entry_key] = (cache, prefix_keys, tuple(input_ids[:entry_key[0]]))
+        self._prefix_cache.move_to_end(entry_key)
+        for key in prefix_keys:
+            self._prefix_index[key] = entry_key
+
+        while len(self._prefix_cache) > 1 and (
+                len(self._prefix_cache) > self.max_cached_prefixes or self._prefix_memory_exceeded()):
+            evicted_key, evicted = self._prefix_cache.popitem(last=False)
+            evicted_prefix_keys = evicted[1]
+            # Drop the last reference to the evicted cache before memory is measured again
+            del evicted
+            for key in evicted_prefix_keys:
+                if self._prefix_index.get(key) == evicted_key:
+                    del self._prefix_index[key]
+
+    def _prefix_memory_exceeded(self) -> bool:
+        if self.model.device.type != "cuda":
+            return False
+        total_memory = torch.cuda.get_device_properties(self.model.device).total_memory
+        return torch.cuda.memory_allocated(self.model.device) > self.prefix_cache_memory_fraction * total_memory
+
+    def _pad_prompts(self, prompts: List[List[int]]) -> Dict[str, torch.Tensor]:
+        """Left-pad prompts to a common width on the model device, bucketed for a compiled model"""
+        width = max(len(prompt) for prompt in prompts)
+        if self.model.generation_config.cache_implementation == "static":
+            width = next((bucket for bucket in self.prefill_buckets if bucket >= width), width)
+        padded = self.tokenizer.pad({"input_ids": prompts}, padding="max_length", max_length=width, return_tensors="pt")
+        return {name: self._to_device(tensor) for name, tensor in padded.items()}
+
+    def _to_device(self, tensor: torch.Tensor) -> torch.Tensor:
+        """Copy a host tensor to the model device, asynchronously from pinned memory on CUDA"""
+        if self.model.device.type != "cuda":
+            return tensor.to(self.model.device)
+        # The copy is queued on the current stream, ahead of the prefill kernels that read it
+        return tensor.pin_memory().to(self.model.device, non_blocking=True)
+
+    def _cache_kwargs(self, batch_size: int, total_length: int) -> Dict[str, Any]:
+        """Reuse a preallocated StaticCache for each compiled batch size.
+
+        generate would otherwise allocate a new static cache whenever the batch size
+        changes or a request needs a longer one, fragmenting the allocator, and the
+        changed shape sends the compiled forward back to recompile.
+        Only called on the model thread.
+        """
+        if (self.model.generation_config.cache_implementation != "static"
+                or batch_size not in self._static_batch_sizes or total_length > self.static_cache_len):
+            return {}
+
+        static_cache = self._static_caches.get(batch_size)
+        if static_cache is None:
+            static_cache = self._static_caches[batch_size] = StaticCache(
+                config=self.model.config,
+                max_batch_size=batch_size,
+                max_cache_len=self.static_cache_len,
+                device=self.model.device,
+                dtype=self.model.dtype
+            )
+        else:
+            static_cache.reset()
+        # generate rejects an explicit cache alongside cache_implementation
+        return {"past_key_values": static_cache, "cache_implementation": None}
+
+    def _split_completions(self, outputs, prompt_width: int, max_new_tokens: List[int]) -> List[List[int]]:
+        """Cut each generated row down to its own token budget and first EOS"""
+        eos_token_id = self.tokenizer.eos_token_id
+        results = []
+        for row, limit in zip(outputs[:, prompt_width:].tolist(), max_new_tokens):
+            row = row[:limit]
+            if eos_token_id in row:
+                row = row[:row.index(eos_token_id) + 1]
+            results.append(row)
+        return results
+
+class VLLMGenerationBatcher(GenerationBatcher):
+    """Hands each request straight to a vLLM AsyncLLMEngine.
+
+    The engine batches at the iteration level (continuous batching): a request joins
+    the running batch at the next decode step and leaves it as soon as it finishes,
+    with the KV cache paged across requests, so no batching window is needed here.
+    Shared prefixes are reused by the engine's own prefix caching.
+    """
+    def start(self):
+        self._request_ids = itertools.count()
+
+    async def stop(self):
+        pass
+
+    async def warm_up(self):
+        await self.generate([self.tokenizer.pad_token_id] * 8, 20, 0.0)
+
+    async def generate(self, input_ids: List[int], max_new_tokens: int, temperature: float, prefix_length: int = 0) -> List[int]:
+        completion_ids: List[int] = []
+        async with aclosing(self._engine_generate(input_ids, max_new_tokens, temperature)) as completions:
+            async for completion in completions:
+                completion_ids = completion.token_ids
+        return list(completion_ids)
+
+    async def stream(self, input_ids: List[int], max_new_tokens: int, temperature: float,
+                     prefix_length: int = 0) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        sent = 0
+        finish_reason = None
+        # Closing the engine stream right away aborts the request if the client has gone
+        async with aclosing(self._engine_generate(input_ids, max_new_tokens, temperature)) as completions:
+            async for completion in completions:
+                # The engine reports the text generated so far; pass on only what is new
+                if len(completion.text) > sent:
+                    yield completion.text[sent:], None
+                    sent = len(completion.text)
+                finish_reason = completion.finish_reason
+        yield "", finish_reason or "stop"
+
+    async def _engine_generate(self, input_ids: List[int], max_new_tokens: int, temperature: float):
+        from vllm import SamplingParams
+
+        request_id = f"req-{next(self._request_ids)}"
+        finished = False
+        try:
+            async for request_output in self.model.generate(
+                {"prompt_token_ids": input_ids},
+                SamplingParams(temperature=temperature, max_tokens=max_new_tokens),
+                request_id
+            ):
+                finished = request_output.finished
+                yield request_output.outputs[0]
+        finally:
+            if not finished:
+                # Client went away mid-stream; free the request's slot in the running batch
+                await self.model.abort(request_id)
@@ -1,20 +1,36 @@
 import argparse
-import json
+import asyncio
+import base64
+import functools
+import hashlib
 import time
 import logging
-from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Callable, Literal, Optional, Union
 import os
 import sys
 
+import anyio
+import httpx
+import numpy
+import orjson
 import torch
-from flask import Flask, request, jsonify
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, ConfigDict, Field, StringConstraints, TypeAdapter
+from pydantic import ValidationError as PydanticValidationError
+from typing_extensions import Annotated, TypedDict
+from transformers import AutoTokenizer, AutoModel, AutoModelForCausalLM, BitsAndBytesConfig, GPTQConfig
 import openai
 
+from batching import GenerationBatcher, VLLMGenerationBatcher
 from error_handling import (
-    handle_errors, validate_request_data, rate_limit, require_api_key,
-    log_request, with_resource_management, resource_manager,
-    ValidationError, SecurityError, ResourceError
+    handle_errors, log_request, secure_endpoint, resource_manager, register_error_handlers,
+    ORJSONResponse, ValidationError, ResourceError
 )
 
 # Setup logging
@@ -24,14 +40,93 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Size the worker thread pool so blocking model calls are never starved by it"""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens, resource_manager.max_concurrent_requests)
+    
+    # Build the model list against the final configuration, before the first request
+    _models_json.cache_clear()
+    _models_json()
+    _default_model_name.cache_clear()
+    
+    global batcher
+    if model is not None and tokenizer is not None:
+        batcher_class = VLLMGenerationBatcher if inference_backend == "vllm" else GenerationBatcher
+        batcher = batcher_class(model, tokenizer)
+        batcher.start()
+        # Pay lazy imports, kernel selection and every compilation at startup instead of on the
+        # first requests, where compile time would count against their generation time budget
+        logger.info("Warming up model")
+        await batcher.warm_up()
+        logger.info("Model warm-up finished")
+    if embedding_model is not None and embedding_tokenizer is not None:
+        # Two batch shapes, so a compiled encoder also builds its dynamic-shape graph now
+        await _run_embedding(["warm up"])
+        await _run_embedding(["warm up", "warm up the embedding model"])
+    try:
+        yield
+    finally:
+        if batcher is not None:
+            await batcher.stop()
+            batcher = None
+
+# Largest request body read into memory, matching the endpoints' max_size
+MAX_REQUEST_BODY_SIZE = 1024 * 1024
+
+class ORJSONRequest(Request):
+    """Request whose JSON body is parsed by orjson"""
+    async def body(self) -> bytes:
+        if not hasattr(self, "_body"):
+            # Refuse on the declared size before reading, then bound what actually arrives (chunked bodies)
+            if int(self.headers.get('content-length') or 0) > MAX_REQUEST_BODY_SIZE:
+                raise ValidationError(f"Request too large. Maximum size: {MAX_REQUEST_BODY_SIZE} bytes")
+            chunks = []
+            received = 0
+            async for chunk in self.stream():
+                received += len(chunk)
+                if received > MAX_REQUEST_BODY_SIZE:
+                    raise ValidationError(f"Request too large. Maximum size: {MAX_REQUEST_BODY_SIZE} bytes")
+                chunks.append(chunk)
+            self._body = b"".join(chunks)
+        return self._body
+    
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+class ORJSONRoute(APIRoute):
+    """Route that parses request bodies with orjson, both for FastAPI and our validators"""
+    def get_route_handler(self) -> Callable:
+        route_handler = super().get_route_handler()
+        
+        async def orjson_route_handler(request: Request):
+            request = ORJSONRequest(request.scope, request.receive)
+            # Read (and size-check) the body here, before FastAPI parses it into the endpoint's model
+            await request.body()
+            return await route_handler(request)
+        return orjson_route_handler
+
+# orjson by default, so any route returning a plain dict skips the stdlib encoder too
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.router.route_class = ORJSONRoute
+register_error_handlers(app)
 
 # Global variables
 model = None
 tokenizer = None
 embedding_model = None
+embedding_tokenizer = None
+# The compiled encoder is not safe to call from several threads at once, so every
+# embedding pass runs on this one thread
+embedding_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+batcher = None
 model_type = "chat"
 model_size = "small"
+inference_backend = "transformers"
+quantization = "bnb4"
 third_party_client = None
 use_third_party = False
 
@@ -54,6 +149,23 @@ MODEL_MAP = {
     }
 }
 
+# Pre-quantized 4-bit checkpoints used by --quantization awq/gptq
+PREQUANTIZED_MODELS = {
+    "awq": {
+        "TinyLlama/TinyLlama-1.1B-Chat-v1.0": "TheBloke/TinyLlama-1.1B-Chat-v1.0-AWQ",
+        "HuggingFaceH4/mistral-7b-instruct-v0.2": "TheBloke/Mistral-7B-Instruct-v0.2-AWQ"
+    },
+    "gptq": {
+        "TinyLlama/TinyLlama-1.1B-Chat-v1.0": "TheBloke/TinyLlama-1.1B-Chat-v1.0-GPTQ",
+        "HuggingFaceH4/mistral-7b-instruct-v0.2": "TheBloke/Mistral-7B-Instruct-v0.2-GPTQ"
+    }
+}
+
+# Maximum number of texts encoded per embedding forward pass
+EMBEDDING_BATCH_SIZE = 32
+# Longest input the embedding encoders accept (BERT-style position embeddings)
+EMBEDDING_MAX_LENGTH = 512
+
 # Third-party model configurations
 THIRD_PARTY_MODELS = {
     "dashscope": {
@@ -66,8 +178,67 @@ THIRD_PARTY_MODELS = {
     }
 }
 
+class ChatMessage(TypedDict):
+    """One entry of a chat request's messages"""
+    __pydantic_config__ = ConfigDict(extra="allow")
+
+    role: Literal['system', 'user', 'assistant']
+    content: Annotated[str, StringConstraints(max_length=8000)]
+
+# Compiled once; messages come back as plain dicts for the templates and the third-party client
+_chat_messages_adapter = TypeAdapter(Annotated[List[ChatMessage], Field(min_length=1)])
+
+def _validate_chat_messages(messages: List[Any]) -> List[Dict[str, str]]:
+    """Validate chat messages in one pydantic-core pass, reporting the first problem as a ValidationError"""
+    try:
+        return _chat_messages_adapter.validate_python(messages)
+    except PydanticValidationError as e:
+        errors = e.errors()
+    
+    if any(not error["loc"] for error in errors):
+        raise ValidationError("Messages must be a non-empty array", "messages")
+    i = min(error["loc"][0] for error in errors)
+    message_errors = {error["loc"][1:]: error["type"] for error in errors if error["loc"][0] == i}
+    if () in message_errors:
+        raise ValidationError(f"Message {i} must be an object", f"messages[{i}]")
+    if "missing" in message_errors.values():
+        raise ValidationError(f"Message {i} missing role or content", f"messages[{i}]")
+    if ("role",) in message_errors:
+        raise ValidationError(f"Invalid role in message {i}", f"messages[{i}].role")
+    if message_errors.get(("content",)) == "string_too_long":
+        raise ValidationError(f"Content in message {i} too long", f"messages[{i}].content")
+    raise ValidationError(f"Content in message {i} must be string", f"messages[{i}].content")
+
+class ChatCompletionRequest(BaseModel):
+    """Request body for /v1/chat/completions"""
+    model_config = ConfigDict(extra="allow")
+
+    messages: List[Any]
+    max_tokens: int = 1024
+    temperature: float = 0.7
+    model: Optional[str] = None
+    stream: bool = False
+
+class CompletionRequest(BaseModel):
+    """Request body for /v1/completions"""
+    model_config = ConfigDict(extra="allow")
+
+    prompt: str = ''
+    max_tokens: int = 1024
+    temperature: float = 0.7
+    model: Optional[str] = None
+    stream: bool = False
+
+class EmbeddingRequest(BaseModel):
+    """Request body for /v1/embeddings"""
+    model_config = ConfigDict(extra="allow")
+
+    input: Union[str, List[str]] = []
+    model: Optional[str] = None
+    encoding_format: Literal["float", "base64"] = "float"
+
 def initialize_model():
-    global model, tokenizer, embedding_model, model_type, model_size, third_party_client, use_third_party
+    global model, tokenizer, embedding_model, embedding_tokenizer, model_type, model_size, inference_backend, quantization, third_party_client, use_third_party
     
     # Setup Hugging Face mirror for China mainland
     if os.getenv('HF_ENDPOINT'):
@@ -85,7 +256,12 @@ def initialize_model():
     device = "cuda" if torch.cuda.is_available() else "cpu"
     logger.info(f"Using device: {device}")
     
+    if inference_backend == "vllm" and device != "cuda":
+        logger.warning("vLLM backend requires CUDA, falling back to transformers")
+        inference_backend = "transformers"
+    
     try:
+        # One causal LM backs both /v1/chat/completions and /v1/completions
         if model_type in ["chat", "completion"]:
             logger.info(f"Downloading tokenizer for: {model_id}")
             tokenizer = AutoTokenizer.from_pretrained(
@@ -93,33 +269,300 @@ def initialize_model():
                 cache_dir=os.getenv('TRANSFORMERS_CACHE', None),
                 trust_remote_code=True
             )
+            # Batched generation left-pads prompts so completions line up
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            tokenizer.padding_side = "left"
             logger.info(f"Downloading model for: {model_id}")
-            model = AutoModelForCausalLM.from_pretrained(
-                model_id,
-                torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-                low_cpu_mem_usage=True,
-                device_map=device,
-                cache_dir=os.getenv('TRANSFORMERS_CACHE', None),
-                trust_remote_code=True
-            )
+            if inference_backend == "vllm":
+                model = _load_vllm_engine(model_id, quantization)
+                # vLLM claims most of the device for its KV cache up front
+                resource_manager.gpu_memory_threshold = 1.0
+            else:
+                model = _load_quantized_model(model_id, quantization) if device == "cuda" and quantization != "none" else None
+            if model is None:
+                model = _load_pretrained(
+                    AutoModelForCausalLM,
+                    model_id,
+                    torch_dtype=_model_dtype(device),
+                    low_cpu_mem_usage=True,
+                    device_map=_device_map(device),
+                    cache_dir=os.getenv('TRANSFORMERS_CACHE', None),
+                    trust_remote_code=True
+                )
+            if inference_backend == "transformers":
+                model.eval()
+            # bitsandbytes, AWQ and GPTQ kernels do not compose with torch.compile, and neither
+            # do accelerate's cross-device hooks on a model sharded over several GPUs
+            if (device == "cuda" and inference_backend == "transformers" and not _is_sharded(model)
+                    and not getattr(model, "is_quantized", False)):
+                _compile_model(model)
         
         if model_type == "embedding" or model_size == "large":
             embedding_model_id = MODEL_MAP[model_size]["embedding"]
             logger.info(f"Initializing embedding model: {embedding_model_id}")
-            embedding_model = pipeline(
-                "feature-extraction", 
-                model=embedding_model_id, 
-                device=device,
-                model_kwargs={
-                    "cache_dir": os.getenv('TRANSFORMERS_CACHE', None),
-                    "trust_remote_code": True
-                }
+            embedding_tokenizer = AutoTokenizer.from_pretrained(
+                embedding_model_id,
+                use_fast=True,
+                cache_dir=os.getenv('TRANSFORMERS_CACHE', None),
+                trust_remote_code=True
             )
+            embedding_model = _load_pretrained(
+                AutoModel,
+                embedding_model_id,
+                torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+                cache_dir=os.getenv('TRANSFORMERS_CACHE', None),
+                trust_remote_code=True
+            ).to(device).eval()
+            if device == "cpu":
+                embedding_model = _quantize_cpu_encoder(embedding_model)
+            else:
+                # Inductor fuses each layer's LayerNorm, GELU and residual adds into the matmul
+                # epilogues; after the first new batch shape it recompiles once with dynamic shapes
+                embedding_model.forward = torch.compile(embedding_model.forward)
     except Exception as e:
         logger.error(f"Error downloading/loading model: {str(e)}")
         logger.info("This might be due to network issues. Please check your internet connection and Hugging Face mirror configuration.")
         raise
 
+def _model_dtype(device: str) -> torch.dtype:
+    """Weight dtype for the causal LM: BF16 on Ampere+ GPUs and CPUs with native BF16 matmuls, else FP16 on CUDA"""
+    if device == "cuda":
+        # BF16 has FP32's exponent range, so no overflow in long-context activations; same FlashAttention speed
+        return torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+    # Without AVX512_BF16/AMX the BF16 matmuls are emulated and slower than FP32. torch 2.1 has no
+    # torch.cpu helper for that; its oneDNN check asks for the AVX-512 core BF16 kernels need
+    bf16_supported = getattr(torch.cpu, "_is_avx512_bf16_supported", torch.ops.mkldnn._is_mkldnn_bf16_supported)
+    if bf16_supported():
+        return torch.bfloat16
+    logger.warning("CPU has no native BF16 support, loading FP32 weights")
+    return torch.float32
+
+def _device_map(device: str) -> str:
+    """Place the causal LM on one device, sharding its layers across GPUs when there are several"""
+    if device == "cuda" and torch.cuda.device_count() > 1:
+        return "auto"
+    return device
+
+def _is_sharded(model) -> bool:
+    """Whether accelerate spread the model's layers over more than one device"""
+    return len(set(getattr(model, "hf_device_map", {}).values())) > 1
+
+def _quantize_cpu_encoder(encoder):
+    """Swap the encoder's Linear layers for dynamically quantized INT8 ones (VNNI/AMX matmuls on x86)"""
+    try:
+        torch.ao.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    except Exception as e:
+        # No quantized engine (fbgemm/qnnpack) in this torch build
+        logger.warning(f"Could not quantize embedding model, keeping FP32 weights: {str(e)}")
+        return encoder
+    logger.info("Quantized embedding model Linear layers to INT8")
+    return encoder
+
+def _attn_implementations() -> List[str]:
+    """Attention kernels to try, fastest first"""
+    if torch.cuda.is_available():
+        try:
+            import flash_attn  # noqa: F401
+            return ["flash_attention_2", "sdpa"]
+        except ImportError:
+            pass
+    return ["sdpa"]
+
+def _load_pretrained(model_class, model_id: str, **kwargs):
+    """from_pretrained with FlashAttention-2 or fused SDPA attention where the model supports it"""
+    for attn_implementation in _attn_implementations():
+        try:
+            return model_class.from_pretrained(model_id, attn_implementation=attn_implementation, **kwargs)
+        except (ValueError, ImportError) as e:
+            # Raised when the architecture has no kernel for this implementation
+            logger.warning(f"Could not load {model_id} with {attn_implementation} attention: {str(e)}")
+    return model_class.from_pretrained(model_id, **kwargs)
+
+def _load_quantized_model(model_id: str, method: str = "bnb4"):
+    """Load the causal LM with quantized weights using the given method.
+    
+    bnb4 prefers bitsandbytes 4-bit NF4 and falls back to int8; bnb8 is int8 only.
+    awq and gptq load the pre-quantized 4-bit checkpoint listed in PREQUANTIZED_MODELS.
+    Raises when the method cannot be applied rather than serving unquantized weights;
+    pass --quantization none for FP16.
+    """
+    if method in ("awq", "gptq"):
+        return _load_prequantized_model(model_id, method)
+    
+    try:
+        import bitsandbytes  # noqa: F401
+    except ImportError:
+        raise RuntimeError(f"--quantization {method} needs the bitsandbytes package")
+    
+    quantization_configs = [
+        ("4-bit NF4", BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True
+        )),
+        ("int8", BitsAndBytesConfig(load_in_8bit=True)),
+    ]
+    if method == "bnb8":
+        quantization_configs = quantization_configs[1:]
+    for name, quantization_config in quantization_configs:
+        try:
+            quantized_model = _load_pretrained(
+                AutoModelForCausalLM,
+                model_id,
+                quantization_config=quantization_config,
+                low_cpu_mem_usage=True,
+                device_map="auto",
+                cache_dir=os.getenv('TRANSFORMERS_CACHE', None),
+                trust_remote_code=True
+            )
+            logger.info(f"Loaded {model_id} with {name} quantized weights")
+            return quantized_model
+        except Exception as e:
+            logger.warning(f"Could not load {model_id} with {name} quantization: {str(e)}")
+    
+    raise RuntimeError(f"Could not load {model_id} with {method} quantization")
+
+def _load_prequantized_model(model_id: str, method: str):
+    """Load the AWQ or GPTQ 4-bit checkpoint for model_id, keeping FP16 activations"""
+    quantized_id = PREQUANTIZED_MODELS[method].get(model_id)
+    if quantized_id is None:
+        raise RuntimeError(f"No pre-quantized {method.upper()} checkpoint known for {model_id}")
+    
+    extra_kwargs = {}
+    if method == "gptq":
+        # ExLlama kernels for 4-bit matmuls; the quantization settings come from the checkpoint
+        extra_kwargs["quantization_config"] = GPTQConfig(bits=4, use_exllama=True)
+    try:
+        quantized_model = _load_pretrained(
+            AutoModelForCausalLM,
+            quantized_id,
+            torch_dtype=torch.float16,
+            low_cpu_mem_usage=True,
+            device_map="auto",
+            cache_dir=os.getenv('TRANSFORMERS_CACHE', None),
+            trust_remote_code=True,
+            **extra_kwargs
+        )
+    except Exception as e:
+        raise RuntimeError(f"Could not load {quantized_id} with {method.upper()} weights: {str(e)}") from e
+    
+    logger.info(f"Loaded {quantized_id} with {method.upper()} 4-bit weights")
+    return quantized_model
+
+def _compile_model(model):
+    """Compile the decoder forward pass so decode steps replay as CUDA graphs"""
+    if not getattr(model, "_supports_static_cache", False):
+        logger.info(f"{model.__class__.__name__} does not support a static KV cache, skipping torch.compile")
+        return
+    
+    logger.info("Compiling model forward with torch.compile (reduce-overhead)")
+    # A static KV cache keeps tensor shapes fixed across decode steps, so the
+    # whole forward compiles as one graph
+    model.generation_config.cache_implementation = "static"
+    # GenerationBatcher.warm_up raises dynamo's graph limit to cover every shape it compiles
+    model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=True, dynamic=False)
+
+def _load_vllm_engine(model_id: str, method: str = "none"):
+    """Create an async vLLM engine (PagedAttention KV cache, continuous batching) for model_id"""
+    # vLLM runs AWQ and GPTQ checkpoints with its own kernels; bitsandbytes is not used here
+    vllm_quantization = None
+    if method in ("bnb4", "bnb8"):
+        raise RuntimeError(f"--quantization {method} is not supported with --backend vllm; use awq, gptq or none")
+    if method != "none":
+        quantized_id = PREQUANTIZED_MODELS[method].get(model_id)
+        if quantized_id is None:
+            raise RuntimeError(f"No pre-quantized {method.upper()} checkpoint known for {model_id}")
+        model_id = quantized_id
+        vllm_quantization = method
+    
+    from vllm import AsyncEngineArgs, AsyncLLMEngine
+    engine = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(
+        model=model_id,
+        dtype="float16",
+        quantization=vllm_quantization,
+        download_dir=os.getenv('TRANSFORMERS_CACHE', None),
+        enable_prefix_caching=True,
+        trust_remote_code=True
+    ))
+    logger.info(f"Loaded {model_id} with the vLLM engine")
+    return engine
+
+def _format_chat_prompt(messages: List[Dict[str, str]], add_generation_prompt: bool = True) -> str:
+    """Format messages with the generic role tags, for tokenizers without a chat template"""
+    prompt = "".join(f"<|{msg['role']}|>\n{msg['content']}\n" for msg in messages)
+    return prompt + "<|assistant|>\n" if add_generation_prompt else prompt
+
+@functools.lru_cache(maxsize=64)
+def _system_prompt_ids(content: str, templated: bool) -> tuple:
+    """Token ids of a system prompt on its own, rendered the same way as the whole conversation"""
+    system_messages = [{"role": "system", "content": content}]
+    if templated:
+        return tuple(tokenizer.apply_chat_template(system_messages, return_dict=False))
+    return tuple(tokenizer(_format_chat_prompt(system_messages, add_generation_prompt=False))["input_ids"])
+
+def _encode_chat(messages: List[Dict[str, str]]):
+    """Tokenize a conversation, returning its input ids and the length of a reusable system prefix"""
+    templated = tokenizer.chat_template is not None
+    if templated:
+        try:
+            input_ids = list(tokenizer.apply_chat_template(
+                messages,
+                add_generation_prompt=True,
+                truncation=True,
+                max_length=2048,
+                return_dict=False
+            ))
+        except Exception as e:
+            # Some templates reject role orderings (e.g. no system role); fall back to plain tags
+            logger.warning(f"Chat template failed, using generic prompt format: {str(e)}")
+            templated = False
+    if not templated:
+        input_ids = tokenizer(_format_chat_prompt(messages), truncation=True, max_length=2048)["input_ids"]
+
+    # A leading system prompt is shared across requests, so its KV cache can be reused
+    prefix_length = 0
+    if len(messages) > 1 and messages[0]['role'] == 'system':
+        try:
+            system_ids = _system_prompt_ids(messages[0]['content'], templated)
+        except Exception:
+            system_ids = ()
+        if 0 < len(system_ids) < len(input_ids) and tuple(input_ids[:len(system_ids)]) == system_ids:
+            prefix_length = len(system_ids)
+    return input_ids, prefix_length
+
+# Frames are bytes so StreamingResponse sends orjson's output without a decode/encode round trip
+SSE_DONE = b"data: [DONE]\n\n"
+
+def _sse_event(payload: Dict[str, Any]) -> bytes:
+    """Encode one Server-Sent Events data frame"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+async def _stream_events(texts, build_chunk):
+    """Wrap streamed text pieces into SSE chunks, closing with a finish chunk and [DONE]"""
+    try:
+        async for text, finish_reason in texts:
+            if text:
+                yield _sse_event(build_chunk(text, None))
+            if finish_reason is not None:
+                yield _sse_event(build_chunk(None, finish_reason))
+    except Exception as e:
+        # Headers are already sent, so report the failure inside the stream
+        logger.error(f"Error while streaming response: {str(e)}")
+        yield _sse_event({"error": {"type": "server_error", "code": "INTERNAL_ERROR", "message": "Stream interrupted"}})
+    yield SSE_DONE
+
+async def _stream_third_party(response):
+    """Relay an OpenAI-compatible upstream stream as SSE"""
+    try:
+        async for chunk in response:
+            yield _sse_event(chunk.model_dump(exclude_none=True))
+    except Exception as e:
+        logger.error(f"Third-party stream error: {str(e)}")
+        yield _sse_event({"error": {"type": "server_error", "code": "INTERNAL_ERROR", "message": "Stream interrupted"}})
+    yield SSE_DONE
+
 def initialize_third_party_model():
     global third_party_client, use_third_party
     
@@ -130,10 +573,18 @@ def initialize_third_party_model():
     
     base_url = THIRD_PARTY_MODELS["dashscope"]["base_url"]
     
-    # Initialize OpenAI client with 阿里百炼 configuration
-    third_party_client = openai.OpenAI(
+    # Initialize OpenAI client with 阿里百炼 configuration; the async client awaits
+    # upstream calls on the event loop instead of holding a worker thread each
+    third_party_client = openai.AsyncOpenAI(
         api_key=api_key,
-        base_url=base_url
+        base_url=base_url,
+        timeout=THIRD_PARTY_TIMEOUT,
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            timeout=THIRD_PARTY_TIMEOUT,
+            limits=THIRD_PARTY_LIMITS,
+            transport=httpx.AsyncHTTPTransport(limits=THIRD_PARTY_LIMITS, retries=THIRD_PARTY_CONNECT_RETRIES)
+        )
     )
     
     use_third_party = True
@@ -141,6 +592,7 @@ def initialize_third_party_model():
 
 def get_available_models():
     """Get list of available models based on current configuration"""
+    created = int(time.time()) - 10000
     if use_third_party:
         models = []
         for model_type, model_list in THIRD_PARTY_MODELS["dashscope"]["models"].items():
@@ -148,47 +600,156 @@ def get_available_models():
                 models.append({
                     "id": model_name,
                     "object": "model",
-                    "created": int(time.time()) - 10000,
+                    "created": created,
                     "owned_by": "alililian"
                 })
         return models
     else:
-        models = [
-            {
-                "id": MODEL_MAP["small"]["chat"],
-                "object": "model",
-                "created": int(time.time()) - 10000,
-                "owned_by": "local"
-            },
-            {
-                "id": MODEL_MAP["small"]["completion"],
-                "object": "model",
-                "created": int(time.time()) - 10000,
-                "owned_by": "local"
-            },
+        model_ids = [MODEL_MAP["small"][model_type] for model_type in ["chat", "completion", "embedding"]]
+        if model_size != "small":
+            model_ids += [MODEL_MAP[model_size][model_type] for model_type in ["chat", "completion", "embedding"]]
+        
+        # Sizes share checkpoints, so list each model once
+        return [
             {
-                "id": MODEL_MAP["small"]["embedding"],
+                "id": model_id,
                 "object": "model",
-                "created": int(time.time()) - 10000,
+                "created": created,
                 "owned_by": "local"
-            }
+            } for model_id in dict.fromkeys(model_ids)
         ]
-        
-        if model_size != "small":
-            for model_type in ["chat", "completion", "embedding"]:
-                models.append({
-                    "id": MODEL_MAP[model_size][model_type],
-                    "object": "model",
-                    "created": int(time.time()) - 10000,
-                    "owned_by": "local"
-                })
-        
-        return models
 
-@app.route('/health', methods=['GET'])
+@functools.lru_cache(maxsize=1)
+def _models_json() -> bytes:
+    """Serialized /v1/models body; the model list is fixed once the server has started"""
+    return orjson.dumps({
+        "object": "list",
+        "data": get_available_models()
+    })
+
+# Model reported by third-party requests that do not name one, per endpoint
+THIRD_PARTY_DEFAULT_MODELS = {
+    "chat": "qwen-turbo",
+    "completion": "text-davinci-003",
+    "embedding": "text-embedding-v1"
+}
+
+# Unreachable upstreams fail fast, but reads keep the SDK's 10 minutes so long completions are not cut off.
+# Only connection failures are retried: a request that reached the upstream may already be billed
+THIRD_PARTY_TIMEOUT = openai.Timeout(600.0, connect=5.0)
+THIRD_PARTY_CONNECT_RETRIES = 2
+THIRD_PARTY_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+
+# Third-party results kept for repeated inputs (FAQ texts, RAG chunks, deterministic chats)
+THIRD_PARTY_EMBEDDING_CACHE_SIZE = 10000
+THIRD_PARTY_CHAT_CACHE_SIZE = 1000
+
+class _ResultCache:
+    """Bounded LRU of third-party results, keyed by a digest of the request content"""
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+    
+    @staticmethod
+    def key(*parts) -> bytes:
+        return hashlib.blake2b(orjson.dumps(parts), digest_size=16).digest()
+    
+    def get(self, key: bytes):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+    
+    def put(self, key: bytes, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+third_party_embedding_cache = _ResultCache(THIRD_PARTY_EMBEDDING_CACHE_SIZE)
+third_party_chat_cache = _ResultCache(THIRD_PARTY_CHAT_CACHE_SIZE)
+
+@functools.lru_cache(maxsize=None)
+def _default_model_name(endpoint: str) -> str:
+    """Model name reported when a request does not name one; fixed once the server has started"""
+    if use_third_party:
+        return THIRD_PARTY_DEFAULT_MODELS[endpoint]
+    return MODEL_MAP[model_size]["embedding" if endpoint == "embedding" else model_type]
+
+def _encode_embedding(vector, encoding_format: str):
+    """Embedding as OpenAI returns it: a float list, or base64 of its little-endian float32 bytes"""
+    if encoding_format == "base64":
+        return base64.b64encode(numpy.asarray(vector, dtype="<f4")).decode("ascii")
+    return vector
+
+def _embed_texts(input_texts: List[str], encoding_format: str = "float"):
+    """Compute mean-pooled, L2-normalized embeddings and the number of tokens encoded"""
+    if not input_texts:
+        return [], 0
+    
+    # Batch texts of similar length together so little compute is spent on padding
+    order = sorted(range(len(input_texts)), key=lambda i: len(input_texts[i]))
+    sorted_texts = [input_texts[i] for i in order]
+    
+    # Encode whole batches and pool on the device; only the pooled vectors come back
+    on_cuda = embedding_model.device.type == "cuda"
+    # Pinned host buffer so the device-to-host copies can run asynchronously
+    pooled = torch.empty(
+        (len(input_texts), embedding_model.config.hidden_size),
+        dtype=torch.float32,
+        pin_memory=on_cuda
+    )
+    token_count = 0
+    with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=on_cuda):
+        for start in range(0, len(sorted_texts), EMBEDDING_BATCH_SIZE):
+            encoded = embedding_tokenizer(
+                sorted_texts[start:start + EMBEDDING_BATCH_SIZE],
+                padding=True,
+                truncation=True,
+                max_length=EMBEDDING_MAX_LENGTH,
+                return_tensors="pt"
+            )
+            # Counted on the host copy of the mask, before it moves to the device
+            token_count += int(encoded["attention_mask"].sum())
+            if on_cuda:
+                # Queue the input copy without blocking so the next batch tokenizes while this one runs
+                encoded = {name: tensor.pin_memory().to(embedding_model.device, non_blocking=True) for name, tensor in encoded.items()}
+            hidden = embedding_model(**encoded).last_hidden_state.float()
+            # Average across real tokens only, masking out the batch padding
+            mask = encoded["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            batch_pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+            # Unit length, as sentence-transformers and e5 models (and OpenAI clients) expect
+            batch_pooled = torch.nn.functional.normalize(batch_pooled, dim=-1)
+            pooled[start:start + len(batch_pooled)].copy_(batch_pooled, non_blocking=on_cuda)
+    if on_cuda:
+        torch.cuda.current_stream().synchronize()
+    # Row of each input in the length-sorted buffer, so results return in request order without copying it
+    rows = pooled.numpy()
+    sorted_position = [0] * len(order)
+    for position, i in enumerate(order):
+        sorted_position[i] = position
+    
+    embeddings = [
+        {
+            "object": "embedding",
+            "embedding": _encode_embedding(rows[sorted_position[i]], encoding_format),
+            "index": i
+        # numpy rows go straight to orjson, skipping a Python float per value
+        } for i in range(len(input_texts))
+    ]
+    
+    return embeddings, token_count
+
+async def _run_embedding(input_texts: List[str], encoding_format: str = "float"):
+    """Run _embed_texts on the embedding thread without blocking the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(
+        embedding_executor, functools.partial(_embed_texts, input_texts, encoding_format)
+    )
+
+@app.get('/health')
 @handle_errors
 @log_request
-def health_check():
+async def health_check(request: Request):
     """Enhanced health check with resource status"""
     try:
         status = resource_manager.get_status()
@@ -215,22 +776,18 @@ def health_check():
             status["status"] = "busy"
             status["issues"] = status.get("issues", []) + ["At capacity"]
         
-        return jsonify(status), 200
+        return ORJSONResponse(status, status_code=200)
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
-        return jsonify({
+        return ORJSONResponse({
             "status": "unhealthy",
             "timestamp": int(time.time()),
             "error": str(e)
-        }), 503
+        }, status_code=503)
 
-@app.route('/v1/chat/completions', methods=['POST'])
-@handle_errors
-@log_request
-@rate_limit(max_requests=30, window=60)
-@validate_request_data(required_fields=['messages'])
-@with_resource_management
-def chat_completions():
+@app.post('/v1/chat/completions')
+@secure_endpoint(required_fields=['messages'], max_requests=30, window=60)
+async def chat_completions(request: Request, body: ChatCompletionRequest):
     """Enhanced chat completions with comprehensive validation and error handling"""
     if not use_third_party and (model is None or tokenizer is None):
         raise ResourceError("Model not loaded", "model")
@@ -239,57 +796,50 @@ def chat_completions():
         raise ResourceError("Third-party client not initialized", "client")
     
     try:
-        data = request.get_json()
-        messages = data.get('messages', [])
-        max_tokens = data.get('max_tokens', 1024)
-        temperature = data.get('temperature', 0.7)
-        model_name = data.get('model', 'qwen-turbo' if use_third_party else MODEL_MAP[model_size][model_type])
+        messages = body.messages
+        max_tokens = body.max_tokens
+        temperature = body.temperature
+        model_name = body.model or _default_model_name("chat")
         
-        # Validate parameters
-        if not isinstance(messages, list) or len(messages) == 0:
-            raise ValidationError("Messages must be a non-empty array", "messages")
+        # Validate message format
+        messages = _validate_chat_messages(messages)
         
+        # Validate parameters
         if not (1 <= max_tokens <= 4096):
             raise ValidationError("max_tokens must be between 1 and 4096", "max_tokens")
         
         if not (0.0 <= temperature <= 2.0):
             raise ValidationError("temperature must be between 0.0 and 2.0", "temperature")
         
-        # Validate message format
-        for i, msg in enumerate(messages):
-            if not isinstance(msg, dict):
-                raise ValidationError(f"Message {i} must be an object", f"messages[{i}]")
-            
-            if 'role' not in msg or 'content' not in msg:
-                raise ValidationError(f"Message {i} missing role or content", f"messages[{i}]")
-            
-            if msg['role'] not in ['system', 'user', 'assistant']:
-                raise ValidationError(f"Invalid role in message {i}", f"messages[{i}].role")
-            
-            if not isinstance(msg['content'], str):
-                raise ValidationError(f"Content in message {i} must be string", f"messages[{i}].content")
-            
-            if len(msg['content']) > 8000:
-                raise ValidationError(f"Content in message {i} too long", f"messages[{i}].content")
-        
         logger.info(f"Processing chat completion: {len(messages)} messages, max_tokens={max_tokens}, third_party={use_third_party}")
         
         # Handle third-party models
         if use_third_party:
             start_time = time.time()
+            # Greedy answers are memoized; sampled ones must differ between calls
+            cache_key = None
+            if temperature == 0 and not body.stream:
+                cache_key = _ResultCache.key(model_name, max_tokens, messages)
+                cached = third_party_chat_cache.get(cache_key)
+                if cached is not None:
+                    logger.info("Third-party chat completion served from cache")
+                    return ORJSONResponse(cached)
             try:
-                response = third_party_client.chat.completions.create(
+                response = await third_party_client.chat.completions.create(
                     model=model_name,
                     messages=messages,
                     max_tokens=max_tokens,
-                    temperature=temperature
+                    temperature=temperature,
+                    stream=body.stream
                 )
+                if body.stream:
+                    return StreamingResponse(_stream_third_party(response), media_type="text/event-stream")
                 
                 generation_time = time.time() - start_time
                 logger.info(f"Third-party chat completion successful in {generation_time:.2f}s")
                 
                 # Convert to our standard format
-                return jsonify({
+                result = {
                     "id": response.id,
                     "object": "chat.completion",
                     "created": response.created,
@@ -310,61 +860,65 @@ def chat_completions():
                         "completion_tokens": response.usage.completion_tokens,
                         "total_tokens": response.usage.total_tokens
                     }
-                })
+                }
+                if cache_key is not None:
+                    third_party_chat_cache.put(cache_key, result)
+                return ORJSONResponse(result)
                 
             except Exception as e:
                 logger.error(f"Third-party API error: {str(e)}")
                 raise ResourceError(f"Third-party model error: {str(e)}", "third_party_api")
         
         # Handle local models (existing code)
-        # Format the conversation for the model
-        prompt = ""
-        for msg in messages:
-            role = msg['role']
-            content = msg['content']
-            if role == 'system':
-                prompt += f"<|system|>\n{content}\n"
-            elif role == 'user':
-                prompt += f"<|user|>\n{content}\n"
-            elif role == 'assistant':
-                prompt += f"<|assistant|>\n{content}\n"
-        
-        prompt += "<|assistant|>\n"
-        
-        # Tokenize and check length
-        inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=2048)
-        if inputs["input_ids"].shape[1] > 2048:
+        # Format and tokenize the conversation for the model
+        input_ids, prefix_length = _encode_chat(messages)
+        if len(input_ids) > 2048:
             raise ValidationError("Input too long after tokenization", "messages")
         
-        inputs = inputs.to(model.device)
+        if body.stream:
+            now = time.time()
+            completion_id = f"chatcmpl-{int(now * 1000)}"
+            created = int(now)
+            
+            def build_chunk(text, finish_reason):
+                return {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model_name,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "delta": {"role": "assistant", "content": text} if text is not None else {},
+                            "finish_reason": finish_reason
+                        }
+                    ]
+                }
+            
+            texts = batcher.stream(input_ids, max_new_tokens=min(max_tokens, 1024), temperature=temperature, prefix_length=prefix_length)
+            return StreamingResponse(_stream_events(texts, build_chunk), media_type="text/event-stream")
         
         # Generate response with timeout protection
         start_time = time.time()
-        with torch.no_grad():
-            outputs = model.generate(
-                inputs["input_ids"],
-                max_new_tokens=min(max_tokens, 1024),  # Cap max tokens
-                temperature=temperature,
-                do_sample=temperature > 0,
-                pad_token_id=tokenizer.eos_token_id,
-                attention_mask=inputs.get("attention_mask"),
-                use_cache=True
-            )
+        completion_ids = await batcher.generate(
+            input_ids,
+            max_new_tokens=min(max_tokens, 1024),  # Cap max tokens
+            temperature=temperature,
+            prefix_length=prefix_length
+        )
         
-        generation_time = time.time() - start_time
+        end_time = time.time()
+        generation_time = end_time - start_time
         if generation_time > 30:  # 30 second timeout
             logger.warning(f"Generation took {generation_time:.2f}s, might be too slow")
         
-        response_text = tokenizer.decode(
-            outputs[0][inputs["input_ids"].shape[1]:], 
-            skip_special_tokens=True
-        )
+        response_text = tokenizer.decode(completion_ids, skip_special_tokens=True)
         
         # Create response
         response = {
-            "id": f"chatcmpl-{int(time.time() * 1000)}",
+            "id": f"chatcmpl-{int(end_time * 1000)}",
             "object": "chat.completion",
-            "created": int(time.time()),
+            "created": int(end_time),
             "model": model_name,
             "system_fingerprint": "local-python-model",
             "choices": [
@@ -374,18 +928,18 @@ def chat_completions():
                         "role": "assistant",
                         "content": response_text.strip()
                     },
-                    "finish_reason": "stop"
+                    "finish_reason": batcher.finish_reason(completion_ids)
                 }
             ],
             "usage": {
-                "prompt_tokens": inputs["input_ids"].shape[1],
-                "completion_tokens": outputs.shape[1] - inputs["input_ids"].shape[1],
-                "total_tokens": outputs.shape[1]
+                "prompt_tokens": len(input_ids),
+                "completion_tokens": len(completion_ids),
+                "total_tokens": len(input_ids) + len(completion_ids)
             }
         }
         
         logger.info(f"Chat completion successful: {response['usage']['total_tokens']} tokens in {generation_time:.2f}s")
-        return jsonify(response)
+        return ORJSONResponse(response)
         
     except torch.cuda.OutOfMemoryError:
         torch.cuda.empty_cache()  # Clear GPU cache
@@ -394,13 +948,9 @@ def chat_completions():
         logger.error(f"Error in chat completions: {str(e)}")
         raise
 
-@app.route('/v1/completions', methods=['POST'])
-@handle_errors
-@log_request
-@rate_limit(max_requests=30, window=60)
-@validate_request_data(required_fields=['prompt'])
-@with_resource_management
-def completions():
+@app.post('/v1/completions')
+@secure_endpoint(required_fields=['prompt'], max_requests=30, window=60)
+async def completions(request: Request, body: CompletionRequest):
     """Text completion endpoint with third-party support"""
     if not use_third_party and (model is None or tokenizer is None):
         raise ResourceError("Model not loaded", "model")
@@ -409,11 +959,10 @@ def completions():
         raise ResourceError("Third-party client not initialized", "client")
     
     try:
-        data = request.json
-        prompt = data.get('prompt', '')
-        max_tokens = data.get('max_tokens', 1024)
-        temperature = data.get('temperature', 0.7)
-        model_name = data.get('model', 'text-davinci-003' if use_third_party else MODEL_MAP[model_size][model_type])
+        prompt = body.prompt
+        max_tokens = body.max_tokens
+        temperature = body.temperature
+        model_name = body.model or _default_model_name("completion")
         
         logger.info(f"Completion request with prompt length: {len(prompt)}, third_party={use_third_party}")
         
@@ -421,17 +970,20 @@ def completions():
         if use_third_party:
             start_time = time.time()
             try:
-                response = third_party_client.completions.create(
+                response = await third_party_client.completions.create(
                     model=model_name,
                     prompt=prompt,
                     max_tokens=max_tokens,
-                    temperature=temperature
+                    temperature=temperature,
+                    stream=body.stream
                 )
+                if body.stream:
+                    return StreamingResponse(_stream_third_party(response), media_type="text/event-stream")
                 
                 generation_time = time.time() - start_time
                 logger.info(f"Third-party completion successful in {generation_time:.2f}s")
                 
-                return jsonify({
+                return ORJSONResponse({
                     "id": response.id,
                     "object": "text_completion",
                     "created": response.created,
@@ -455,51 +1007,69 @@ def completions():
                 raise ResourceError(f"Third-party model error: {str(e)}", "third_party_api")
         
         # Handle local models (existing code)
-        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        input_ids = tokenizer(prompt, truncation=True, max_length=2048)["input_ids"]
+        
+        if body.stream:
+            created = int(time.time())
+            completion_id = f"cmpl-{created}"
+            
+            def build_chunk(text, finish_reason):
+                return {
+                    "id": completion_id,
+                    "object": "text_completion",
+                    "created": created,
+                    "model": model_name,
+                    "choices": [
+                        {
+                            "text": text or "",
+                            "index": 0,
+                            "finish_reason": finish_reason
+                        }
+                    ]
+                }
+            
+            texts = batcher.stream(input_ids, max_new_tokens=max_tokens, temperature=temperature)
+            return StreamingResponse(_stream_events(texts, build_chunk), media_type="text/event-stream")
         
         # Generate response
-        outputs = model.generate(
-            inputs["input_ids"],
+        completion_ids = await batcher.generate(
+            input_ids,
             max_new_tokens=max_tokens,
-            temperature=temperature,
-            do_sample=temperature > 0,
+            temperature=temperature
         )
         
-        response_text = tokenizer.decode(outputs[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+        response_text = tokenizer.decode(completion_ids, skip_special_tokens=True)
         
         # Create response
+        created = int(time.time())
         response = {
-            "id": f"cmpl-{int(time.time())}",
+            "id": f"cmpl-{created}",
             "object": "text_completion",
-            "created": int(time.time()),
+            "created": created,
             "model": model_name,
             "choices": [
                 {
                     "text": response_text.strip(),
                     "index": 0,
-                    "finish_reason": "stop"
+                    "finish_reason": batcher.finish_reason(completion_ids)
                 }
             ],
             "usage": {
-                "prompt_tokens": inputs["input_ids"].shape[1],
-                "completion_tokens": outputs.shape[1] - inputs["input_ids"].shape[1],
-                "total_tokens": outputs.shape[1]
+                "prompt_tokens": len(input_ids),
+                "completion_tokens": len(completion_ids),
+                "total_tokens": len(input_ids) + len(completion_ids)
             }
         }
         
-        return jsonify(response)
+        return ORJSONResponse(response)
     
     except Exception as e:
         logger.error(f"Error in completions: {str(e)}")
         raise
 
-@app.route('/v1/embeddings', methods=['POST'])
-@handle_errors
-@log_request
-@rate_limit(max_requests=30, window=60)
-@validate_request_data(required_fields=['input'])
-@with_resource_management
-def embeddings():
+@app.post('/v1/embeddings')
+@secure_endpoint(required_fields=['input'], max_requests=30, window=60)
+async def embeddings(request: Request, body: EmbeddingRequest):
     """Embeddings endpoint with third-party support"""
     if not use_third_party and embedding_model is None:
         raise ResourceError("Embedding model not initialized", "embedding_model")
@@ -508,9 +1078,8 @@ def embeddings():
         raise ResourceError("Third-party client not initialized", "client")
         
     try:
-        data = request.json
-        input_texts = data.get('input', [])
-        model_name = data.get('model', 'text-embedding-v1' if use_third_party else MODEL_MAP[model_size]["embedding"])
+        input_texts = body.input
+        model_name = body.model or _default_model_name("embedding")
         
         if isinstance(input_texts, str):
             input_texts = [input_texts]
@@ -521,27 +1090,50 @@ def embeddings():
         if use_third_party:
             start_time = time.time()
             try:
-                response = third_party_client.embeddings.create(
-                    model=model_name,
-                    input=input_texts
-                )
+                # Only texts not embedded before go upstream, each distinct one once
+                keys = [_ResultCache.key(model_name, text) for text in input_texts]
+                vectors = [third_party_embedding_cache.get(key) for key in keys]
+                missed = {}
+                for i, key in enumerate(keys):
+                    if vectors[i] is None:
+                        missed.setdefault(key, []).append(i)
+                
+                response_model = model_name
+                # Usage counts what was sent upstream; cached inputs cost nothing
+                prompt_tokens = total_tokens = 0
+                if missed:
+                    missed_keys = list(missed)
+                    response = await third_party_client.embeddings.create(
+                        model=model_name,
+                        input=[input_texts[indices[0]] for indices in missed.values()]
+                    )
+                    for embedding in response.data:
+                        key = missed_keys[embedding.index]
+                        vector = numpy.asarray(embedding.embedding, dtype=numpy.float32)
+                        third_party_embedding_cache.put(key, vector)
+                        for i in missed[key]:
+                            vectors[i] = vector
+                    response_model = response.model
+                    prompt_tokens = response.usage.prompt_tokens
+                    total_tokens = response.usage.total_tokens
                 
                 generation_time = time.time() - start_time
-                logger.info(f"Third-party embeddings successful in {generation_time:.2f}s")
+                logger.info(f"Third-party embeddings successful in {generation_time:.2f}s, "
+                            f"{len(input_texts) - sum(len(indices) for indices in missed.values())} cached")
                 
-                return jsonify({
+                return ORJSONResponse({
                     "object": "list",
                     "data": [
                         {
                             "object": "embedding",
-                            "embedding": embedding.embedding,
-                            "index": embedding.index
-                        } for embedding in response.data
+                            "embedding": _encode_embedding(vector, body.encoding_format),
+                            "index": i
+                        } for i, vector in enumerate(vectors)
                     ],
-                    "model": response.model,
+                    "model": response_model,
                     "usage": {
-                        "prompt_tokens": response.usage.prompt_tokens,
-                        "total_tokens": response.usage.total_tokens
+                        "prompt_tokens": prompt_tokens,
+                        "total_tokens": total_tokens
                     }
                 })
                 
@@ -551,23 +1143,7 @@ def embeddings():
         
         # Handle local models (existing code)
         # Generate embeddings
-        embeddings = []
-        token_count = 0
-        
-        for i, text in enumerate(input_texts):
-            # Get embedding
-            embedding_output = embedding_model(text)
-            # Average across tokens to get a single vector per text
-            embedding_vector = torch.mean(torch.tensor(embedding_output[0]), dim=0).tolist()
-            
-            embeddings.append({
-                "object": "embedding",
-                "embedding": embedding_vector,
-                "index": i
-            })
-            
-            # Approximate token count
-            token_count += len(text.split())
+        embeddings, token_count = await _run_embedding(input_texts, body.encoding_format)
         
         # Create response
         response = {
@@ -580,24 +1156,19 @@ def embeddings():
             }
         }
         
-        return jsonify(response)
+        return ORJSONResponse(response)
     
     except Exception as e:
         logger.error(f"Error in embeddings: {str(e)}")
         raise
 
-@app.route('/v1/models', methods=['GET'])
+@app.get('/v1/models')
 @handle_errors
 @log_request
-def list_models():
+async def list_models(request: Request):
     """List available models endpoint"""
     try:
-        models = get_available_models()
-        response = {
-            "object": "list",
-            "data": models
-        }
-        return jsonify(response)
+        return Response(_models_json(), media_type="application/json")
     except Exception as e:
         logger.error(f"Error listing models: {str(e)}")
         raise
@@ -606,20 +1177,24 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Local AI Model Server with Third-Party Support')
     parser.add_argument('--host', type=str, default='localhost', help='Host to bind the server to')
     parser.add_argument('--port', type=int, default=5000, help='Port to bind the server to')
-    parser.add_argument('--model-type', type=str, default='chat', choices=['chat', 'completion', 'embedding'], help='Type of model to use')
+    parser.add_argument('--model-type', type=str, default='chat', choices=['chat', 'completion', 'embedding'], help='Type of model to use (the chat and completion endpoints both serve the one loaded causal LM)')
     parser.add_argument('--model-size', type=str, default='small', choices=['small', 'medium', 'large'], help='Size of model to use')
     parser.add_argument('--use-third-party', action='store_true', help='Use third-party models (阿里百炼)')
+    parser.add_argument('--quantization', type=str, default='bnb4', choices=['none', 'bnb4', 'bnb8', 'awq', 'gptq'], help='Weight quantization for chat/completion models on CUDA (awq/gptq load pre-quantized 4-bit checkpoints; --backend vllm supports only awq, gptq and none); startup fails if it cannot be applied')
+    parser.add_argument('--backend', type=str, default='transformers', choices=['transformers', 'vllm'], help='Inference backend for chat/completion models (vllm requires CUDA and the vllm package)')
     
     args = parser.parse_args()
     
     model_type = args.model_type
     model_size = args.model_size
+    inference_backend = args.backend
+    quantization = args.quantization
     
     # Set environment variable for third-party usage
     if args.use_third_party:
         os.environ['USE_THIRD_PARTY_MODEL'] = 'true'
     
-    logger.info(f"Starting server with model type: {model_type}, size: {model_size}, third_party: {args.use_third_party}")
+    logger.info(f"Starting server with model type: {model_type}, size: {model_size}, backend: {inference_backend}, quantization: {quantization}, third_party: {args.use_third_party}")
     
     try:
         initialize_model()
@@ -628,4 +1203,6 @@ if __name__ == '__main__':
         logger.error(f"Failed to initialize model: {str(e)}")
         sys.exit(1)
     
-    app.run(host=args.host, port=args.port)
+    # A single worker process owns the model; concurrency comes from the event loop
+    # and the batcher's model thread, not from extra processes each loading weights
+    uvicorn.run(app, host=args.host, port=args.port, loop="uvloop", http="httptools")
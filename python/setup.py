@@ -0,0 +1,17 @@
+"""Optional Cython build of the request validation module.
+
+    python setup.py build_ext --inplace
+
+compiles error_handling.py into an extension module, which Python imports in
+preference to the source file. Without the build the module runs as plain Python.
+"""
+from setuptools import Extension, setup
+from Cython.Build import cythonize
+
+setup(
+    name="aigateway-model-server",
+    ext_modules=cythonize(
+        [Extension("error_handling", ["error_handling.py"])],
+        compiler_directives={"language_level": 3},
+    ),
+)
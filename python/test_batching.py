@@ -0,0 +1,120 @@
+import asyncio
+import weakref
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from batching import GenerationBatcher, _crop_cache
+
+class _LegacyDynamicCache:
+    """DynamicCache as transformers 4.41 lays it out: per-layer lists and no crop method"""
+    def __init__(self, layers: int, length: int):
+        self.key_cache = [torch.randn(1, 2, length, 4) for _ in range(layers)]
+        self.value_cache = [torch.randn(1, 2, length, 4) for _ in range(layers)]
+        self._seen_tokens = length
+
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        return self.key_cache[layer_idx].shape[-2]
+
+class _Tokenizer:
+    """The tokenizer attributes the uncompiled single-prompt path reads"""
+    pad_token_id = 0
+    eos_token_id = 1
+
+def _tiny_llama():
+    config = LlamaConfig(
+        vocab_size=64, hidden_size=16, intermediate_size=32, num_hidden_layers=2,
+        num_attention_heads=2, num_key_value_heads=2, max_position_embeddings=256,
+        pad_token_id=0, bos_token_id=2, eos_token_id=1
+    )
+    torch.manual_seed(0)
+    return LlamaForCausalLM(config).eval()
+
+def test_crop_cache_without_crop_method():
+    cache = _LegacyDynamicCache(layers=2, length=40)
+    keys = [tensor.clone() for tensor in cache.key_cache]
+
+    _crop_cache(cache, 32)
+
+    assert cache.get_seq_length() == 32
+    assert cache._seen_tokens == 32
+    for layer, key in enumerate(keys):
+        assert torch.equal(cache.key_cache[layer], key[..., :32, :])
+        assert cache.value_cache[layer].shape[-2] == 32
+
+def test_uncompiled_generate_reuses_prefix_cache():
+    batcher = GenerationBatcher(_tiny_llama(), _Tokenizer())
+    # Several prefix blocks long, so the cache is stored and later cropped to a shared prefix
+    prompt = [2] + list(range(3, 43))
+    follow_up = prompt + list(range(44, 54))
+
+    async def run():
+        batcher.start()
+        try:
+            first = await batcher.generate(prompt, 4, 0.0)
+            second = await batcher.generate(follow_up, 4, 0.0)
+        finally:
+            await batcher.stop()
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert 0 < len(first) <= 4 and 0 < len(second) <= 4
+    # Both prompts are stored; the follow-up was seeded from the first one's blocks
+    assert len(batcher._prefix_cache) == 2
+    assert sorted(length for length, _ in batcher._prefix_cache) == [32, 48]
+
+def test_stream_surfaces_failure_before_generate():
+    batcher = GenerationBatcher(_tiny_llama(), _Tokenizer())
+
+    def fail(prompts):
+        raise ValueError("bad prompt")
+    batcher._pad_prompts = fail
+
+    async def run():
+        batcher.start()
+        try:
+            # Bounded so a regression hangs the test for seconds, not forever
+            async with asyncio.timeout(10):
+                return [item async for item in batcher.stream([2, 3, 4], 4, 0.0)]
+        finally:
+            await batcher.stop()
+
+    try:
+        asyncio.run(run())
+    except RuntimeError as e:
+        assert isinstance(e.__cause__, ValueError)
+    else:
+        raise AssertionError("stream finished although generation failed")
+
+def test_store_prefix_releases_evicted_cache_before_rechecking():
+    batcher = GenerationBatcher(_tiny_llama(), _Tokenizer())
+    batcher.max_cached_prefixes = 100
+    caches = [_LegacyDynamicCache(layers=1, length=32) for _ in range(3)]
+    alive = weakref.WeakSet(caches)
+    for index, cache in enumerate(caches):
+        batcher._store_prefix(cache, [(32, index)], list(range(32)))
+    del caches, cache
+
+    # Stands in for GPU memory: over budget while more than one cache is still alive
+    batcher._prefix_memory_exceeded = lambda: len(alive) > 1
+    batcher._store_prefix(_LegacyDynamicCache(layers=1, length=32), [(32, 3)], list(range(32)))
+
+    # Two older entries make room; a held reference would have forced out the third too
+    assert [key for _, key in batcher._prefix_cache] == [2, 3]
+
+def test_cached_prefix_ignores_colliding_key():
+    batcher = GenerationBatcher(_tiny_llama(), _Tokenizer())
+    cached_prompt = list(range(2, 42))
+    other_prompt = list(range(42, 2, -1))
+    batcher._store_prefix(_LegacyDynamicCache(layers=1, length=40), batcher._prefix_keys(cached_prompt, 0), cached_prompt)
+    # Point the other prompt's keys at the stored entry, as a hash collision would
+    entry_key = next(iter(batcher._prefix_cache))
+    for key in batcher._prefix_keys(other_prompt, 0):
+        batcher._prefix_index[key] = entry_key
+
+    _, cache, cached_length = batcher._cached_prefix(other_prompt, 0)
+
+    assert cached_length == 0 and cache.get_seq_length() == 0
+    _, _, cached_length = batcher._cached_prefix(cached_prompt + [50], 0)
+    assert cached_length == 32
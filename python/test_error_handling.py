@@ -0,0 +1,95 @@
+import asyncio
+import random
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+from error_handling import (
+    _DANGER_RE, _DANGEROUS_PATTERNS, SecurityError, _find_dangerous_pattern, _validate_body_security,
+    resource_manager, secure_endpoint
+)
+
+def _streaming_app():
+    app = FastAPI()
+
+    @app.post("/stream")
+    @secure_endpoint()
+    async def stream(request: Request):
+        async def chunks():
+            await asyncio.sleep(1)
+            yield b"data: late\n\n"
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+    return app
+
+def test_slot_released_when_client_leaves_before_first_chunk():
+    app = _streaming_app()
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "POST", "path": "/stream", "raw_path": b"/stream",
+        "root_path": "", "scheme": "http", "query_string": b"", "server": ("test", 80), "client": ("1.2.3.4", 1),
+        "headers": [(b"content-type", b"application/json"), (b"content-length", b"2")]
+    }
+    messages = [{"type": "http.request", "body": b"{}", "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        # The client is gone by the time the response starts listening for it
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        # Writing to the transport may suspend, which is where the response task is cancelled
+        await asyncio.sleep(0)
+
+    active_before = resource_manager.active_requests
+    asyncio.run(app(scope, receive, send))
+
+    assert resource_manager.active_requests == active_before
+
+def _assert_matches_ignorecase(value):
+    expected = _DANGER_RE.search(value)
+    found = _find_dangerous_pattern(value)
+    assert (found is None) == (expected is None), value
+    if found is not None:
+        assert found.span() == expected.span(), value
+
+def test_dangerous_pattern_agrees_with_ignorecase_on_mixed_case():
+    rng = random.Random(0)
+    filler = "ab AZ19_-/.:\\<>\u00e9\u00df\u0391\u03c3\u0419"
+    for _ in range(20000):
+        parts = []
+        for _ in range(rng.randint(0, 3)):
+            parts.append("".join(rng.choice(filler) for _ in range(rng.randint(0, 6))))
+            pattern = rng.choice(_DANGEROUS_PATTERNS)
+            # Drop a character now and then so near misses are covered too
+            if rng.random() < 0.3:
+                cut = rng.randrange(len(pattern))
+                pattern = pattern[:cut] + pattern[cut + 1:]
+            parts.append("".join(char.upper() if rng.random() < 0.5 else char.lower() for char in pattern))
+        _assert_matches_ignorecase("".join(parts))
+
+def test_dangerous_pattern_agrees_with_ignorecase_on_case_fold_specials():
+    # Dotted and dotless I, long s and the Kelvin sign all match ASCII letters under IGNORECASE
+    for value in (
+        "EVAL \u0130", "\u0130\u0130 eval", "ev\u0131l", "f\u0131le", "\u0131\u0131\u0131",
+        "<\u017fcript>", "javascr\u0131pt:", "powershe\u017f\u017f", "\u212a /etc/", "rm -rf \u212a",
+        "\u0130nnocent text", "\u212aelvin", "po\u017fitive"
+    ):
+        _assert_matches_ignorecase(value)
+
+def test_cached_rejection_is_reraised_with_same_message_and_code():
+    body = b'{"messages": [{"role": "user", "content": "<SCRIPT>cached()"}]}'
+    data = {"messages": [{"role": "user", "content": "<SCRIPT>cached()"}]}
+
+    errors = []
+    # The second call's data is clean, so only the verdict cached for the body can reject it
+    for parsed in (data, {}):
+        try:
+            _validate_body_security(body, parsed)
+        except SecurityError as e:
+            errors.append(e)
+
+    assert len(errors) == 2
+    assert errors[0] is not errors[1]
+    assert (errors[1].message, errors[1].code) == (errors[0].message, errors[0].code)
+    assert errors[0].message.startswith("Dangerous pattern detected")